@@ -1,9 +1,16 @@
 from __future__ import annotations
 
+import asyncio
+import csv
+import json
 import logging
-import sys
+import os
+import re
 import typing as t
-from functools import singledispatch
+from contextlib import contextmanager
+from datetime import datetime
+from functools import cache, partial
+from pathlib import Path
 
 from mcp.types import (
     EmbeddedResource,
@@ -11,7 +18,7 @@ from mcp.types import (
     TextContent,
     Tool,
 )
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 from telethon import TelegramClient, custom, functions, types  # type: ignore[import-untyped]
 
 from .telegram import create_client
@@ -30,9 +37,9 @@ logger = logging.getLogger(__name__)
 #    Attributes of the class will be used as arguments for the tool.
 #    The class docstring will be used as the tool description.
 #
-# 2. Implement the tool_runner function for the new class
+# 2. Implement the runner function for the new class and register it
 #    ```python
-#    @tool_runner.register
+#    @register(NewTool)
 #    async def new_tool(args: NewTool) -> t.Sequence[TextContent | ImageContent | EmbeddedResource]:
 #        pass
 #    ```
@@ -46,37 +53,64 @@ class ToolArgs(BaseModel):
     model_config = ConfigDict()
 
 
-@singledispatch
+ToolRunner = t.Callable[[t.Any], t.Awaitable[t.Sequence[TextContent | ImageContent | EmbeddedResource]]]
+
+_TOOLS: dict[str, tuple[type[ToolArgs], ToolRunner]] = {}
+
+
+def register(args: type[ToolArgs]) -> t.Callable[[ToolRunner], ToolRunner]:
+    def decorator(fn: ToolRunner) -> ToolRunner:
+        _TOOLS[args.__name__] = (args, fn)
+        return fn
+
+    return decorator
+
+
 async def tool_runner(
-    args,  # noqa: ANN001
+    args: ToolArgs,
 ) -> t.Sequence[TextContent | ImageContent | EmbeddedResource]:
-    raise NotImplementedError(f"Unsupported type: {type(args)}")
+    entry = _TOOLS.get(type(args).__name__)
+    if entry is None:
+        raise NotImplementedError(f"Unsupported type: {type(args)}")
+    return await entry[1](args)
 
 
+@cache
+def _schema_for(args: type[ToolArgs]) -> dict[str, t.Any]:
+    return args.model_json_schema()
+
+
+@cache
 def tool_description(args: type[ToolArgs]) -> Tool:
     return Tool(
         name=args.__name__,
         description=args.__doc__,
-        inputSchema=args.model_json_schema(),
+        inputSchema=_schema_for(args),
     )
 
 
-def tool_args(tool: Tool, *args, **kwargs) -> ToolArgs:  # noqa: ANN002, ANN003
-    return sys.modules[__name__].__dict__[tool.name](*args, **kwargs)
+def tool_args(tool: Tool, *args: t.Any, **kwargs: t.Any) -> ToolArgs:  # noqa: ANN401
+    return _TOOLS[tool.name][0](*args, **kwargs)
 
 
 ### ListDialogs ###
 
 
 class ListDialogs(ToolArgs):
-    """List available dialogs, chats and channels."""
+    """
+    List available dialogs, chats and channels.
+
+    If `limit` is set, at most `limit` dialogs will be listed. If `unread` is set, the listing stops as soon as
+    `limit` unread dialogs are found.
+    """
 
     unread: bool = False
     archived: bool = False
     ignore_pinned: bool = False
+    limit: t.Annotated[int, Field(ge=1)] | None = None
 
 
-@tool_runner.register
+@register(ListDialogs)
 async def list_dialogs(
     args: ListDialogs,
 ) -> t.Sequence[TextContent | ImageContent | EmbeddedResource]:
@@ -86,14 +120,22 @@ async def list_dialogs(
     response: list[TextContent] = []
     async with create_client() as client:
         dialog: custom.dialog.Dialog
-        async for dialog in client.iter_dialogs(archived=args.archived, ignore_pinned=args.ignore_pinned):
+        # Dialogs are fetched page by page, so stopping early saves the remaining requests.
+        # Without the unread filter every dialog counts, and the limit can be left to Telethon.
+        async for dialog in client.iter_dialogs(
+            limit=None if args.unread else args.limit,
+            archived=args.archived,
+            ignore_pinned=args.ignore_pinned,
+        ):
             if args.unread and dialog.unread_count == 0:
                 continue
             msg = (
                 f"name='{dialog.name}' id={dialog.id} "
                 f"unread={dialog.unread_count} mentions={dialog.unread_mentions_count}"
             )
-            response.append(TextContent(type="text", text=msg))
+            response.append(TextContent.model_construct(type="text", text=msg))
+            if args.limit is not None and len(response) >= args.limit:
+                break
 
     return response
 
@@ -117,7 +159,13 @@ class ListMessages(ToolArgs):
     limit: int = 100
 
 
-@tool_runner.register
+def _unread_count(result: types.messages.PeerDialogs, dialog_id: int) -> int:
+    if not result.dialogs:
+        raise ValueError(f"Channel not found: {dialog_id}")
+    return result.dialogs[-1].unread_count
+
+
+@register(ListMessages)
 async def list_messages(
     args: ListMessages,
 ) -> t.Sequence[TextContent | ImageContent | EmbeddedResource]:
@@ -133,36 +181,217 @@ async def list_messages(
         if not isinstance(result, types.messages.PeerDialogs):
             raise TypeError(f"Unexpected result: {type(result)}")
 
-        for dialog in result.dialogs:
-            logger.debug("dialog: %s", dialog)
-        for message in result.messages:
-            logger.debug("message: %s", message)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            for dialog in result.dialogs:
+                logger.debug("dialog: %s", dialog)
+            for message in result.messages:
+                logger.debug("message: %s", message)
 
         iter_messages_args: dict[str, t.Any] = {
             "entity": args.dialog_id,
             "reverse": False,
         }
         if args.unread:
-            iter_messages_args["limit"] = min(dialog.unread_count, args.limit)
+            iter_messages_args["limit"] = min(_unread_count(result, args.dialog_id), args.limit)
         else:
             iter_messages_args["limit"] = args.limit
 
         logger.debug("iter_messages_args: %s", iter_messages_args)
         async for message in client.iter_messages(**iter_messages_args):
-            logger.debug("message: %s", type(message))
+            if debug:
+                logger.debug("message: %s %s", type(message), getattr(message, "text", None))
             if isinstance(message, custom.Message) and message.text:
-                logger.debug("message: %s", message.text)
-                response.append(TextContent(type="text", text=message.text))
+                response.append(TextContent.model_construct(type="text", text=message.text))
 
     return response
 
 
+### SearchHashtags ###
+
+_EXPORT_BUFFER_SIZE = 1 << 20
+_EXPORT_BATCH_SIZE = 1000
+_SEARCH_CONCURRENCY = 4
+
+
+_EXPORT_FIELDS = ("date", "user_id", "username", "message", "hashtag")
+
+# One exported match, in the order of _EXPORT_FIELDS
+_ExportRow = tuple[str, int | None, str, str, str]
+
+
+def _write_txt_records(f: t.TextIO, rows: t.Iterable[_ExportRow]) -> None:
+    for date, user_id, username, message, hashtag in rows:
+        f.write(f"Date: {date}\n")
+        f.write(f"User: {username} (ID: {user_id})\n")
+        f.write(f"Message: {message}\n")
+        f.write(f"Hashtag: {hashtag}\n")
+        f.write("-" * 50 + "\n")
+
+
+class _IsoDateFormatter:
+    """`datetime.isoformat()` reusing the formatted minute for consecutive dates within the same minute."""
+
+    def __init__(self) -> None:
+        self._key: tuple[t.Any, ...] | None = None
+        self._prefix = ""
+        self._suffix = ""
+
+    def __call__(self, d: datetime) -> str:
+        if d.microsecond:
+            return d.isoformat()
+        key = (d.year, d.month, d.day, d.hour, d.minute, d.tzinfo)
+        if key != self._key:
+            iso = d.isoformat()
+            # "YYYY-MM-DDTHH:MM" + ":SS" + offset, if any
+            self._key, self._prefix, self._suffix = key, iso[:16], iso[19:]
+            return iso
+        return f"{self._prefix}:{d.second:02d}{self._suffix}"
+
+
+class _HashtagExport:
+    """Matches messages against the searched hashtags and writes the matches to the export in batches."""
+
+    def __init__(
+        self,
+        hashtags: list[str],
+        write_rows: t.Callable[[list[_ExportRow]], t.Any],
+        min_id: int,
+        head_id: int,
+    ) -> None:
+        # Match all hashtags in a single pass over each message, case-insensitively
+        self._pattern = re.compile("(" + "|".join(map(re.escape, hashtags)) + ")", re.IGNORECASE)
+        self._hashtag_by_lc = {hashtag.lower(): hashtag for hashtag in reversed(hashtags)}
+        self._format_date = _IsoDateFormatter()
+        self._write_rows = write_rows
+        self._batch: list[_ExportRow] = []
+        # A message carrying several hashtags is returned once per hashtag, hence the dedup by id
+        self._seen_ids: set[int] = set()
+        # Only messages in (min_id, head_id] are scanned: head_id is the newest message when the scan started,
+        # so messages posted meanwhile are left for the next run for every hashtag alike
+        self.min_id = min_id
+        self.head_id = head_id
+        self.count = 0
+
+    def add(self, message: custom.Message) -> None:
+        if message.id in self._seen_ids or not message.text:
+            return
+        match = self._pattern.search(message.text)
+        if not match:
+            return
+        self._seen_ids.add(message.id)
+        matched = match.group(1)
+        row = (
+            self._format_date(message.date),
+            message.sender_id,
+            message.sender.username if message.sender else "Unknown",
+            message.text,
+            self._hashtag_by_lc.get(matched.lower(), matched),
+        )
+        self._batch.append(row)
+        self.count += 1
+        if len(self._batch) >= _EXPORT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._batch:
+            self._write_rows(self._batch)
+            self._batch.clear()
+
+
+async def _scan_hashtag(
+    client: TelegramClient,
+    group: t.Any,  # noqa: ANN401
+    hashtag: str,
+    export: _HashtagExport,
+    semaphore: asyncio.Semaphore,
+) -> None:
+    async with semaphore:
+        async for message in client.iter_messages(
+            group,
+            search=hashtag,
+            min_id=export.min_id,
+            max_id=export.head_id + 1,
+        ):
+            export.add(message)
+
+
+async def _scan_hashtags(client: TelegramClient, group: t.Any, hashtags: list[str], export: _HashtagExport) -> None:  # noqa: ANN401
+    # Let Telegram search for each hashtag server-side instead of downloading the whole history.
+    # The searches run concurrently on the same client, a few at a time to stay within flood limits.
+    semaphore = asyncio.Semaphore(_SEARCH_CONCURRENCY)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for hashtag in hashtags:
+                tg.create_task(_scan_hashtag(client, group, hashtag, export, semaphore))
+    except* Exception as eg:  # noqa: BLE001
+        # The other searches are cancelled on the first failure; report its actual cause
+        raise eg.exceptions[0] from None
+
+
+def _cursor_scope(group_id: int, hashtags: list[str]) -> dict[str, t.Any]:
+    return {"group_id": group_id, "hashtags": sorted({hashtag.lower() for hashtag in hashtags})}
+
+
+def _read_cursor(path: Path, scope: dict[str, t.Any]) -> int | None:
+    """Return the newest message id stored in the cursor, if it was written for the same group and hashtags."""
+    try:
+        cursor = json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return None
+    if not isinstance(cursor, dict) or any(cursor.get(key) != value for key, value in scope.items()):
+        return None
+    max_id = cursor.get("max_id")
+    return max_id if isinstance(max_id, int) else None
+
+
+def _write_cursor(path: Path, scope: dict[str, t.Any], max_id: int) -> None:
+    path.write_text(json.dumps({**scope, "max_id": max_id}), encoding="utf-8")
+
+
+@contextmanager
+def _open_export(path: Path, *, append: bool, newline: str | None) -> t.Iterator[t.TextIO]:
+    """
+    Open the export for writing so that a failed run leaves it as it was.
+
+    An appended export is truncated back to its original size on failure. A new export is written to a temporary
+    file that replaces `path` only if the block completes.
+    """
+    target = path if append else path.with_name(f"{path.name}.tmp")
+    size = path.stat().st_size if append else 0
+    try:
+        with target.open(
+            "a" if append else "w",
+            buffering=_EXPORT_BUFFER_SIZE,
+            newline=newline,
+            encoding="utf-8",
+        ) as f:
+            yield f
+    except BaseException:
+        if append:
+            os.truncate(path, size)
+        else:
+            target.unlink(missing_ok=True)
+        raise
+    if not append:
+        target.replace(path)
+
+
 class SearchHashtags(ToolArgs):
-    """Search for specific hashtags in a Telegram group and export results to CSV."""
+    """
+    Search for specific hashtags in a Telegram group and export results to CSV.
+
+    The id of the newest scanned message is stored next to the export file. The next run with the same
+    `output_file`, `group_id` and `hashtags` only scans messages newer than that and appends them to the export;
+    any other run rescans the group and overwrites the export. Set `since_id` to export only messages newer than
+    the given id instead; `since_id=0` rescans the whole group.
+    """
+
     group_id: int
     hashtags: list[str]
     output_format: str = "csv"  # csv or txt
     output_file: str = "hashtag_results"
+    since_id: int | None = None
 
     class Config:
         json_schema_extra = {
@@ -170,66 +399,53 @@ class SearchHashtags(ToolArgs):
                 "group_id": -1001234567890,
                 "hashtags": ["#intro", "#интро", "#iam", "#whois"],
                 "output_format": "csv",
-                "output_file": "intro_messages"
+                "output_file": "intro_messages",
             }
         }
 
-@tool_runner.register
-async def search_hashtags(args: SearchHashtags) -> t.Sequence[TextContent]:
+
+@register(SearchHashtags)
+async def search_hashtags(
+    args: SearchHashtags,
+) -> t.Sequence[TextContent | ImageContent | EmbeddedResource]:
     """Search for specific hashtags in a Telegram group and export results."""
-    try:
-        # Initialize Telegram client
-        client = await create_client()
-        
-        # Get the group entity
-        group = await client.get_entity(args.group_id)
-        
-        # Initialize results
-        messages = []
-        total_count = 0
-        
-        # Search for messages with hashtags
-        async for message in client.iter_messages(group):
-            if message.text:
-                for hashtag in args.hashtags:
-                    if hashtag.lower() in message.text.lower():
-                        messages.append({
-                            'date': message.date.isoformat(),
-                            'user_id': message.sender_id,
-                            'username': message.sender.username if message.sender else 'Unknown',
-                            'message': message.text,
-                            'hashtag': hashtag
-                        })
-                        total_count += 1
-                        break  # Break once we find a matching hashtag
-        
-        # Export results
-        if args.output_format == "csv":
-            import csv
-            with open(f"{args.output_file}.csv", 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=['date', 'user_id', 'username', 'message', 'hashtag'])
-                writer.writeheader()
-                writer.writerows(messages)
-        else:  # txt format
-            with open(f"{args.output_file}.txt", 'w', encoding='utf-8') as f:
-                for msg in messages:
-                    f.write(f"Date: {msg['date']}\n")
-                    f.write(f"User: {msg['username']} (ID: {msg['user_id']})\n")
-                    f.write(f"Message: {msg['message']}\n")
-                    f.write(f"Hashtag: {msg['hashtag']}\n")
-                    f.write("-" * 50 + "\n")
-        
-        await client.disconnect()
-        
-        return [
-            TextContent(
-                text=f"Successfully exported {total_count} messages with hashtags {', '.join(args.hashtags)} to {args.output_file}.{args.output_format}"
-            )
-        ]
-        
-    except Exception as e:
-        return [
-            TextContent(
-                text=f"Error searching hashtags: {str(e)}"
-            )
-        ]
+    client: TelegramClient
+    logger.info("method[SearchHashtags] args[%s]", args)
+
+    async with create_client() as client:
+        try:
+            group = await client.get_entity(args.group_id)
+
+            # Write matches to disk as they are found instead of collecting them first
+            is_csv = args.output_format == "csv"
+            export_file = Path(f"{args.output_file}.{'csv' if is_csv else 'txt'}")
+            cursor_file = export_file.with_name(f"{export_file.name}.cursor")
+            scope = _cursor_scope(args.group_id, args.hashtags)
+            resume_id = _read_cursor(cursor_file, scope) if args.since_id is None and export_file.exists() else None
+            min_id = resume_id if resume_id is not None else args.since_id or 0
+            latest = await client.get_messages(group, limit=1)
+            head_id = max(latest[0].id if latest else 0, min_id)
+            with _open_export(export_file, append=resume_id is not None, newline="" if is_csv else None) as f:
+                write_rows: t.Callable[[list[_ExportRow]], t.Any]
+                if is_csv:
+                    writer = csv.writer(f)
+                    if f.tell() == 0:
+                        writer.writerow(_EXPORT_FIELDS)
+                    write_rows = writer.writerows
+                else:  # txt format
+                    write_rows = partial(_write_txt_records, f)
+
+                export = _HashtagExport(args.hashtags, write_rows, min_id, head_id)
+                await _scan_hashtags(client, group, args.hashtags, export)
+                export.flush()
+
+            _write_cursor(cursor_file, scope, head_id)
+
+        except Exception as e:
+            logger.exception("Error searching hashtags in %s", args.group_id)
+            return [TextContent.model_construct(type="text", text=f"Error searching hashtags: {e!s}")]
+
+    hashtags = ", ".join(args.hashtags)
+    appended = f" (appended, newer than message {min_id})" if resume_id is not None else ""
+    msg = f"Successfully exported {export.count} messages with hashtags {hashtags} to {export_file}{appended}"
+    return [TextContent.model_construct(type="text", text=msg)]